@@ -1,11 +1,20 @@
+import atexit
 import os
+import re
+import shutil
 import struct
 import subprocess as shell
-import audible_kennedn as audible
-import httpx
-from getpass import getpass
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from glob import glob
+from operator import attrgetter
+from stat import S_ISREG
 from tempfile import mkstemp
 from sys import platform
+from types import MappingProxyType
+
+# Activation body layout, 8 slots of 70 bytes with 1 pad byte in between
+_CLEAN_STRUCT = struct.Struct("70s1x" * 8)
 
 
 class MenuItem:
@@ -16,11 +25,21 @@ class MenuItem:
         A simple string representing item
     action:
         A Description string to be displayed in menu"""
+    __slots__ = ('action', 'prompt')
+
     def __init__(self, prompt, action):
         self.action = action
         self.prompt = prompt
 
 
+# Main menu entries never change, main() only chooses which of them to display
+_ACTIVATE_ITEM = MenuItem('activate', "Activate device (Will require login to Amazon)")
+_DEVICE_ITEM = MenuItem('device', "Save to Device")
+_SAVE_ITEM = MenuItem('save', "Save to file")
+_PRINT_ITEM = MenuItem('print', "Print activation bytes")
+_EXIT_ITEM = MenuItem('exit', "Exit Program")
+
+
 class Kindle:
     """Represents a Kindle device, contianing necessary information to activate device
 
@@ -46,76 +65,115 @@ class Kindle:
     is_mounted:
         Check self.mountpoint is set
     remote_file_exists:
-        Check if activation exists on device
+        Check if activation exists on device, as found at construction or last save
     filepath:
-        Return path to device activation
+        Return path to device activation if it exists
     bytes:
         Derive and return activation bytes from self.activation
     model:
         Lookup serial prefix in model_lookup table, return model string.
     """
-    model_lookup = {'B001': 'Kindle 1',
-                    'B101': 'Kindle 1',
-                    'B002': 'Kindle 2',
-                    'B003': 'Kindle 2',
-                    'B004': 'Kindle DX',
-                    'B005': 'Kindle DX',
-                    'B009': 'Kindle DX Graphite',
-                    'B008': 'Kindle 3 WiFi',
-                    'B006': 'Kindle 3 3G',
-                    'B00A': 'Kindle 3 3G',
-                    'B00C': 'Kindle PaperWhite',
-                    'B00E': 'Kindle 4',
-                    'B00F': 'Kindle Touch 3G',
-                    'B011': 'Kindle Touch WiFi',
-                    'B010': 'Kindle Touch 3G',
-                    'B023': 'Kindle 4',
-                    '9023': 'Kindle 4'}
+    model_lookup = MappingProxyType({0xB001: 'Kindle 1',
+                                     0xB101: 'Kindle 1',
+                                     0xB002: 'Kindle 2',
+                                     0xB003: 'Kindle 2',
+                                     0xB004: 'Kindle DX',
+                                     0xB005: 'Kindle DX',
+                                     0xB009: 'Kindle DX Graphite',
+                                     0xB008: 'Kindle 3 WiFi',
+                                     0xB006: 'Kindle 3 3G',
+                                     0xB00A: 'Kindle 3 3G',
+                                     0xB00C: 'Kindle PaperWhite',
+                                     0xB00E: 'Kindle 4',
+                                     0xB00F: 'Kindle Touch 3G',
+                                     0xB011: 'Kindle Touch WiFi',
+                                     0xB010: 'Kindle Touch 3G',
+                                     0xB023: 'Kindle 4',
+                                     0x9023: 'Kindle 4'})
     default = None
+    __slots__ = ('serial', '_serial_bytes', 'mountpoint', 'remote_file', '_remote_path',
+                 'activation', '_remote_size', '_bytes_cache', '_model')
 
     def __init__(self, serial: str, mountpoint=None):
         self.serial = serial
+        self._serial_bytes = serial.encode()
         self.mountpoint = mountpoint
         self.remote_file = "/system/AudibleActivation.sys"
+        # Path to the device activation, built once as mountpoint never changes
+        self._remote_path = f"{mountpoint}{self.remote_file}" if mountpoint is not None else None
         self.activation = None
+        self._remote_size = None
+        self._bytes_cache = None
+        # Serial never changes, so resolve the model name once up front. Prefixes
+        # are 16-bit hex, so model_lookup is keyed by int rather than string
+        try:
+            self._model = Kindle.model_lookup.get(int(serial[:4], 16), "Unknown")
+        except ValueError:
+            self._model = "Unknown"
         self.__local_activate()
         # Effectivly sets first Object invocation as default
         if self.default is None:
             Kindle.default = self
 
     def __local_activate(self):
-        # Sanity check that local activation exists and is the right size
-        if self.is_mounted and self.remote_file_exists and os.stat(self.filepath).st_size == 0x230:
-            with open(self.filepath, 'rb') as activation:
-                a = activation.read()
-            # Further sanity check, make sure our serial number appears in the activation
-            if (a.find(self.serial.encode())):
-                self.activation = a
+        if not self.is_mounted:
+            return
+        # Open once and fstat the descriptor, so the path is only resolved on the device
+        # once. O_BINARY stops Windows translating newlines in the activation.
+        try:
+            fd = os.open(self._remote_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        except OSError:
+            return
+        try:
+            st = os.fstat(fd)
+            if not S_ISREG(st.st_mode):
+                return
+            # Cache size for remote_file_exists
+            self._remote_size = st.st_size
+            # Sanity check that local activation is the right size
+            if self._remote_size != 0x230:
+                return
+            a = os.read(fd, 0x230)
+        finally:
+            os.close(fd)
+        # Further sanity check, make sure our serial number appears in the activation
+        if self._serial_bytes in a:
+            self.activation = a
 
     @staticmethod
-    def __clean(activation):
-        """ Strips newline characters from activation body """
-        fmt = "70s1x" * 8  # 8 slots of 70 bytes with 1 pad byte in between
+    def __clean(activation, offset=0):
+        """ Strips newline characters from activation body starting at offset """
         # Unpack returns a list of slots, join to reform activation byte object
-        return b''.join(struct.unpack(fmt, activation))
+        return b''.join(_CLEAN_STRUCT.unpack_from(activation, offset))
 
     def activate(self, auth):
-        # Audible returns activation that contains metadata, extracting 0x238 bytes
-        # from the end discards this metadata.
-        self.activation = self.__clean(auth.get_activation(self.serial)[-0x238:])
+        # Audible returns activation that contains metadata, unpacking the 0x238 bytes
+        # at the end in place discards this metadata without copying them out first.
+        activation = auth.get_activation(self.serial)
+        self.activation = self.__clean(activation, len(activation) - _CLEAN_STRUCT.size)
 
     def save(self, location=None):
         # Save Activation bytes to device or passed location
         try:
             if location is None and self.is_mounted:
-                location = f"{self.mountpoint}{self.remote_file}"
+                location = self._remote_path
             elif location is None and not self.is_mounted:
                 raise IOError("Not mounted")
             if not self.is_activated:
                 raise ValueError("Not Activated")
 
-            with open(location, 'wb') as token:
-                token.write(self.activation)
+            fd = os.open(location, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+            try:
+                remaining = memoryview(self.activation)
+                while remaining:
+                    remaining = remaining[os.write(fd, remaining):]
+                # Flush through to storage, so unplugging the Kindle straight after can't lose it
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            # Keep cached device activation state in step with what was just written
+            if location == self._remote_path:
+                self._remote_size = len(self.activation)
             return True
         except IOError as e:
             return False
@@ -130,66 +188,184 @@ class Kindle:
 
     @property
     def remote_file_exists(self):
-        return os.path.isfile(f"{self.mountpoint}{self.remote_file}")
+        return self._remote_size is not None
 
     @property
     def filepath(self):
         if self.remote_file_exists:
-            return f"{self.mountpoint}{self.remote_file}"
+            return self._remote_path
 
     @property
     def bytes(self):
-        # Unpack first 4 bytes of activation in little-endian order to produce activation bytes
+        # First 4 bytes of activation read in little-endian order produce activation bytes
         if self.is_activated:
-            return "{:x}".format(*struct.unpack("<I", self.activation[:4]))
+            # Memoized against the activation object it was derived from, so any
+            # replacement of self.activation is picked up
+            if self._bytes_cache is None or self._bytes_cache[0] is not self.activation:
+                self._bytes_cache = (self.activation, self.activation[3::-1].hex())
+            return self._bytes_cache[1]
         else:
             return None
 
     @property
     def model(self):
-        # Lookup serial prefix to get a human readible device name
-        return Kindle.model_lookup.get(self.serial[:4], "Unknown")
+        # Human readible device name, looked up from serial prefix in __init__
+        return self._model
+
+
+_http_client = None
+
+
+def http_client():
+    """Returns a shared httpx.Client so repeat requests reuse pooled connections"""
+    global _http_client
+    if _http_client is None:
+        # Deferred as only the captcha path needs an HTTP client
+        import httpx
+        _http_client = httpx.Client(timeout=30)
+        atexit.register(_http_client.close)
+    return _http_client
 
 
 def custom_captcha_callback(captcha_url: str) -> str:
     """Opens captcha image with eog, or default webbrowser as fallback"""
-    try:
-        captcha = httpx.get(captcha_url).content
-        fd, path = mkstemp()
-        with os.fdopen(fd, 'wb') as file:
-            file.write(captcha)
-        shell.Popen(["eog", path])
-        val = input("Enter Captcha: ")
-    except FileNotFoundError:
+    viewer = shutil.which("eog")
+    if viewer is None:
         import webbrowser
         webbrowser.open(captcha_url)
-        val = input("Enter Captcha: ")
+        return input("Enter Captcha: ")
+
+    fd, path = mkstemp()
+    try:
+        # Stream straight to disk rather than buffering the whole image first
+        with os.fdopen(fd, 'wb') as file, http_client().stream("GET", captcha_url) as response:
+            for chunk in response.iter_bytes():
+                file.write(chunk)
+        shell.Popen([viewer, path])
+        return input("Enter Captcha: ")
     finally:
         os.remove(path)
-    return val
+
+
+def udev_partitions() -> list:
+    """Reads the udev database directly, returning a properties dict for each block partition"""
+    partitions = []
+    for partition in glob("/sys/class/block/*/partition"):
+        sys_path = os.path.dirname(partition)
+        properties = {'DEVNAME': f"/dev/{os.path.basename(sys_path)}"}
+        try:
+            # The dev file holds the major:minor pair used to name the udev database entry
+            with open(f"{sys_path}/dev") as dev:
+                major_minor = dev.read().strip()
+            with open(f"/run/udev/data/b{major_minor}") as data:
+                # Property lines take the form E:KEY=VALUE
+                for line in data:
+                    if line.startswith("E:"):
+                        key, _, value = line[2:].rstrip("\n").partition("=")
+                        properties[key] = value
+        except OSError:
+            # Partition vanished since the glob, or its entry is unreadable, skip it
+            continue
+        partitions.append(properties)
+    return partitions
+
+
+def mounted_partitions() -> dict:
+    """Reads /proc/mounts once, returning a /dev location -> mountpoint dict"""
+    partitions = {}
+    with open("/proc/mounts") as mounts:
+        for line in mounts:
+            device, mountpoint = line.split(" ", 2)[:2]
+            # Whitespace in mountpoints is escaped as octal, e.g. \040 for a space. Keep the
+            # first mount of a device if it is mounted more than once
+            partitions.setdefault(device, re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), mountpoint))
+    return partitions
 
 
 def auto_detect() -> list:
-    """Queries pyudev and psutil to build a list of connected Kindle objects"""
-    import pyudev
-    from psutil import disk_partitions
-    context = pyudev.Context()
-    # Get all partitition devices
-    devices = context.list_devices(subsystem='block', DEVTYPE='partition')
+    """Queries the udev database and mount table to build a list of connected Kindle objects"""
+    # Cheap check for any Amazon USB device before enumerating partitions
+    for vendor_path in glob("/sys/bus/usb/devices/*/idVendor"):
+        try:
+            with open(vendor_path) as vendor:
+                vendor_id = vendor.read().strip()
+        except OSError:
+            # Device unplugged since the glob, skip it
+            continue
+        if vendor_id == '1949':
+            break
+    else:
+        return []
+    if os.path.isdir("/run/udev/data"):
+        devices = udev_partitions()
+    else:
+        # No udev database to read from, fall back to asking libudev
+        import pyudev
+        context = pyudev.Context()
+        # libudev ORs property matches together, so match vendor there and DEVTYPE here
+        devices = context.list_devices(subsystem='block', ID_VENDOR_ID='1949')
+        devices = [d.properties for d in devices if d.device_type == 'partition']
     # Filter down further to only those with Amazon as vendor
-    devices = list(d for d in devices if d.properties.get('ID_VENDOR_ID') == '1949')
-    kindles = []
-    for device in devices:
-        # Find related mountpoint by comparing /dev location with psutil
-        point = next((d.mountpoint for d in disk_partitions() if d.device == device.properties.get('DEVNAME')), None)
-        serial = device.properties.get('ID_SERIAL_SHORT')
-        kindles.append(Kindle(serial, point))
+    devices = list(d for d in devices if d.get('ID_VENDOR_ID') == '1949')
+    if not devices:
+        return []
+    # Build a /dev location -> mountpoint lookup once, rather than rescanning per device
+    partitions = mounted_partitions()
+
+    def create_kindle(device):
+        # Find related mountpoint by comparing /dev location with the mount table
+        point = partitions.get(device.get('DEVNAME'))
+        serial = device.get('ID_SERIAL_SHORT')
+        return Kindle(serial, point)
+
+    # Creating a Kindle reads its activation over USB, so overlap that I/O across devices
+    if len(devices) > 1:
+        default = Kindle.default
+        with ThreadPoolExecutor(max_workers=min(len(devices), 8)) as executor:
+            kindles = list(executor.map(create_kindle, devices))
+        # Constructors finish in any order, so make the first detected device the default
+        if default is None:
+            Kindle.default = kindles[0]
+        return kindles
     # Return a list of kindle objects
-    return kindles
+    return [create_kindle(device) for device in devices]
+
+
+_auth = None
 
 
 def login():
-    """Present user challanges to generate a valid login with audible"""
+    """Returns a valid audible login, reusing this session's login while it is fresh"""
+    global _auth
+    # Skips re-reading the token file (or logging in again) on repeat activations
+    if _auth is None or _auth.expires <= datetime.now().timestamp():
+        _auth = authenticate()
+    return _auth
+
+
+def authenticate():
+    """Present user challanges to generate a valid login with audible
+
+    A previous login is reused from ~/.kindlepass/.auth.token while it is fresh,
+    and refreshed in place once it expires. A full login is only required when no
+    usable token exists."""
+    # Deferred as audible pulls in a large import graph only needed for activation
+    import audible_kennedn as audible
+    token_path = f"{os.path.expanduser('~')}/.kindlepass/.auth.token"
+    if os.path.isfile(token_path):
+        try:
+            auth = audible.FileAuthenticator(token_path)
+            if auth.expires > datetime.now().timestamp():
+                return auth
+            # Token is stale, revalidate it without prompting the user
+            auth.refresh_access_token()
+        except Exception:
+            # Corrupt token or failed refresh, fall back to a full login
+            auth = None
+        if auth is not None:
+            save_token(auth, token_path)
+            return auth
+
     codes = ["uk", "us", "ca", "au", "fr", "de", "jp", "it", "in"]
     if DEBUG > 1:
         from creds import user, password, locale
@@ -198,15 +374,42 @@ def login():
         password = choice("Password: ", secret=True)
         locale = choice("Country Code (uk, us, ca, au, fr, de, jp, it, in): ", codes)
 
-    return audible.LoginAuthenticator(user, password, locale=locale, captcha_callback=custom_captcha_callback)
+    auth = audible.LoginAuthenticator(user, password, locale=locale, captcha_callback=custom_captcha_callback)
+    save_token(auth, token_path)
+    return auth
 
 
-def choice(prompt: str, item_list=[], secret=False) -> str:
+def save_token(auth, token_path: str) -> None:
+    """Writes auth to token_path, readable only by the current user
+
+    Failing to save is reported but not fatal, the login is still usable this session."""
+    try:
+        token_dir = os.path.dirname(token_path)
+        os.makedirs(token_dir, mode=0o700, exist_ok=True)
+        os.chmod(token_dir, 0o700)
+        # Create the token owner-only before audible writes to it, so it is never
+        # readable by other users, even briefly
+        fd = os.open(token_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            if hasattr(os, 'fchmod'):
+                # Tighten a token left behind with looser permissions
+                os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+        auth.to_file(token_path, encryption=False)
+    except OSError as e:
+        colored_print(Colors.WARN, f"\nCouldn't save login to {token_path}: {e}\n")
+
+
+def choice(prompt: str, item_list=None, secret=False) -> str:
     """Captures user input, repeating prompt if input not in item_list"""
     ret = None
+    if secret:
+        from getpass import getpass
     cmd = getpass if secret else input
-    if len(item_list) > 0:
-        while ret not in item_list:
+    if item_list:
+        allowed = frozenset(item_list)
+        while ret not in allowed:
             ret = cmd(prompt)
     else:
         while ret is None or ret == "":
@@ -234,39 +437,41 @@ def align_table(table: list) -> list:
     arguments:
     table -- A list of rows (containing list of strings)
     """
-    # Flip list so that rows become columns for easier processing
-    column_list = list(zip(*table))
-    for i in range(len(column_list)):
-        # Calculate max length for a given column
-        max_length = max([len(r.expandtabs()) for r in column_list[i]])
-        # overwrite column with padded members
-        column_list[i] = [r.ljust(max_length, " ") for r in column_list[i]]
-    # Flip list again to return rows to columns
-    return list(zip(*column_list))
-
-
-def generate_menu(object_list: list, menu_data: dict, display_index=False) -> None:
+    # Calculate max length for each column, zip flips rows into columns
+    widths = [max(len(r) for r in column) for column in zip(*table)]
+    # Pad each member of each row out to its column width
+    return [tuple(r.ljust(w, " ") for r, w in zip(row, widths)) for row in table]
+
+
+def generate_menu(object_list: list, menu_data: tuple, display_index=False) -> None:
     """Builds and prints a menu out of a list of objects and passed data.
 
     arguments:
     object_list -- A list of objects
-    menu_data -- A Dictionary whose Keys are Menu headings and whose values are
-                 Object Properties to be extracted from each object passed in object_list
+    menu_data -- A tuple of (Menu heading, Object Property) pairs, properties are
+                 extracted from each object passed in object_list
     display_index -- Indicates whether an index be displayed to the left of menu table"""
     table = []
 
-    # Generate Heading row from keys in menu_data dict
+    # Generate Heading row from headings in menu_data
     if display_index:
-        table.append(["# ", *(k for k in menu_data)])
+        table.append(["# ", *(heading for heading, _ in menu_data)])
     else:
-        table.append([k for k in menu_data])
+        table.append([heading for heading, _ in menu_data])
+
+    # Fetch every property defined in menu_data with a single call per object
+    getter = attrgetter(*(prop for _, prop in menu_data))
+    if len(menu_data) == 1:
+        # attrgetter returns a bare value rather than a tuple for a single property
+        single_getter = getter
+        getter = lambda item: (single_getter(item),)
 
     # Generate a row for each object, resolving properties defined in menu_data
     for i, item in enumerate(object_list):
         if display_index:
-            table.append([f"{str(i + 1)} ", *(str(getattr(item, v)) for v in menu_data.values())])
+            table.append([f"{str(i + 1)} ", *map(str, getter(item))])
         else:
-            table.append([str(getattr(item, v)) for v in menu_data.values()])
+            table.append(list(map(str, getter(item))))
 
     # Align columns in table
     table = align_table(table)
@@ -275,13 +480,13 @@ def generate_menu(object_list: list, menu_data: dict, display_index=False) -> No
         print(*item)
 
 
-def prompt_user(object_list: list, menu_data: dict) -> object:
+def prompt_user(object_list: list, menu_data: tuple) -> object:
     """Present a prompt to select from items listed in a selection menu
 
     arguments:
     object_list -- A list of objects
-    menu_data -- A Dictionary whose Keys are Menu headings and whose values are
-                 Object Properties to be extracted from each object passed in object_list
+    menu_data -- A tuple of (Menu heading, Object Property) pairs, properties are
+                 extracted from each object passed in object_list
     display_index -- Indicates whether an index be displayed to the left of menu table"""
 
     selected_object = None
@@ -308,10 +513,10 @@ def main(args=None):
         kindle = auto_detect()
 
     # Build simple menu for kindle display
-    kindle_menu = {'MODEL': 'model',
-                   'SERIAL': 'serial',
-                   'MOUNTED': 'is_mounted',
-                   'ACTIVATED': 'is_activated'}
+    kindle_menu = (('MODEL', 'model'),
+                   ('SERIAL', 'serial'),
+                   ('MOUNTED', 'is_mounted'),
+                   ('ACTIVATED', 'is_activated'))
 
     if len(kindle) == 0:
         """ Create a dummy Kindle object from a provided serial if none were auto-detected """
@@ -349,16 +554,16 @@ def main(args=None):
         # Build menu objects list for each desired action
         selection_menu = []
 
-        selection_menu.append(MenuItem('activate', "Activate device (Will require login to Amazon)", ))
+        selection_menu.append(_ACTIVATE_ITEM)
         if kindle.is_mounted and kindle.is_activated:
-            selection_menu.append(MenuItem('device', "Save to Device", ))
+            selection_menu.append(_DEVICE_ITEM)
         if kindle.is_activated:
-            selection_menu.append(MenuItem('save', "Save to file",))
-            selection_menu.append(MenuItem('print', "Print activation bytes"))
-        selection_menu.append(MenuItem('exit', "Exit Program"))
+            selection_menu.append(_SAVE_ITEM)
+            selection_menu.append(_PRINT_ITEM)
+        selection_menu.append(_EXIT_ITEM)
 
         # Display menu and prompt user for a selection
-        prompt = prompt_user(selection_menu, {'ACTION': 'action'}).prompt
+        prompt = prompt_user(selection_menu, (('ACTION', 'action'),)).prompt
 
         if prompt == "activate":
             """ Attempt to activate kindle """
@@ -380,8 +585,7 @@ def main(args=None):
             """ Save to location, providing hints for next steps """
             path = f"{os.path.expanduser('~')}/.kindlepass/{kindle.serial}"
             location = f"{path}/AudibleActivation.sys"
-            if not os.path.exists(path):
-                os.makedirs(path)
+            os.makedirs(path, exist_ok=True)
             user_location = input(f"Enter Location (Default ~/.kindlepass/{kindle.serial}/AudibleActivation.sys): ")
             if user_location != "":
                 location = user_location
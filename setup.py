@@ -7,7 +7,7 @@ with open("README.md", "r") as fh:
 install_requires = ["httpx==0.14.*",
                     "audible_kennedn @ https://github.com/kennedn/Audible/tarball/master#egg=audible_kennedn-0.5dev0"]
 if platform == "linux" or platform == "linux2":
-    install_requires.extend(("pyudev", "psutil"))
+    install_requires.append("pyudev")
 
 setuptools.setup(
     name="kindlepass",